@@ -1,47 +1,116 @@
 import asyncio
-import aiohttp
+import functools
+import logging
+import time
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram import F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime
 from config import TELEGRAM_TOKEN, CHECK_INTERVAL, CHANNEL_USERNAME
-from flights import get_countries, get_cities_by_country, get_flights_for_date, get_flightable_directions, find_city_by_name, is_valid_iata_code
-from db import init_db, add_search, get_all_searches, update_price, get_user_searches, get_user_subscriptions
-import aiosqlite
+from flights import get_countries, get_cities_by_country, get_city_index, get_flights_for_date, get_flightable_directions, find_city_by_name, is_valid_iata_code, close_http_session, prune_flights_cache
+from db import init_db, get_db, close_db, add_search, add_searches_bulk, get_all_searches, update_price, update_prices_bulk, get_user_searches, get_user_subscriptions
 from typing import Optional
 
+logger = logging.getLogger(__name__)
+
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
+@dp.shutdown()
+async def on_shutdown():
+    await close_http_session()
+    await close_db()
+
+# Статичные клавиатуры собираются один раз при импорте — они никогда не меняются
+
 # Главное меню (ReplyKeyboardMarkup)
-def get_main_menu() -> ReplyKeyboardMarkup:
-    keyboard = [
-        [KeyboardButton(text="Найти билет"), KeyboardButton(text="Подписаться на билет")],
-        [KeyboardButton(text="Список подписок"), KeyboardButton(text="История поиска")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+MAIN_MENU = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="Найти билет"), KeyboardButton(text="Подписаться на билет")],
+    [KeyboardButton(text="Список подписок"), KeyboardButton(text="История поиска")]
+], resize_keyboard=True)
 
 # Клавиатура для подписки на канал
-def get_channel_subscription_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
-        [InlineKeyboardButton(text="✅ Я подписался", callback_data="check_subscription")]
-    ])
+CHANNEL_SUBSCRIPTION_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
+    [InlineKeyboardButton(text="✅ Я подписался", callback_data="check_subscription")]
+])
 
 # Инлайн-кнопка "Назад"
-def get_back_button() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data="back_to_menu")]
-    ])
+BACK_BUTTON = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Назад", callback_data="back_to_menu")]
+])
 
 # Inline-кнопка "В меню"
+INLINE_MENU_BUTTON = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="В меню", callback_data="back_to_menu")]
+])
+
+def get_main_menu() -> ReplyKeyboardMarkup:
+    return MAIN_MENU
+
+def get_channel_subscription_keyboard() -> InlineKeyboardMarkup:
+    return CHANNEL_SUBSCRIPTION_KEYBOARD
+
+def get_back_button() -> InlineKeyboardMarkup:
+    return BACK_BUTTON
+
 def get_inline_menu_button() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="В меню", callback_data="back_to_menu")]
-    ])
+    return INLINE_MENU_BUTTON
+
+# Общий ограничитель исходящих сообщений: Telegram режет бота на ~30 msg/s,
+# поэтому держим темп чуть ниже и возвращаем "жетон" через секунду
+SEND_SEMAPHORE = asyncio.Semaphore(25)
+
+# Помимо общего темпа Telegram ограничивает и ~1 msg/s в один чат:
+# chat_id -> момент, на который занят ближайший слот отправки
+_chat_send_at: dict = {}
+
+async def safe_send(send_coro, chat_id=None):
+    """Выполняет отправку, не превышая общий темп ~25 msg/s.
+
+    С chat_id дополнительно выдерживает секундную паузу между
+    сообщениями в один и тот же чат."""
+    if chat_id is not None:
+        now = time.monotonic()
+        slot = max(now, _chat_send_at.get(chat_id, 0))
+        _chat_send_at[chat_id] = slot + 1.0
+        if slot > now:
+            await asyncio.sleep(slot - now)
+    await SEND_SEMAPHORE.acquire()
+    asyncio.get_running_loop().call_later(1.0, SEND_SEMAPHORE.release)
+    return await send_coro
+
+# Тексты приветствий — одинаковые строки не пересобираем на каждый /start
+GREETING_SUBSCRIBED = (
+    "👋 Привет! Я бот для поиска авиабилетов.\n\n"
+    "Вот что я умею:\n"
+    "✈️ Найти билеты по направлениям и дате вылета (включая пересадки)\n"
+    "💰 Подписаться на билеты и получать уведомления о снижении цены на 10% и более\n"
+    "📜 Просмотреть историю ваших поисков\n"
+    "📌 Посмотреть и управлять подписками\n\n"
+    "Выберите действие ниже, чтобы начать:"
+)
+GREETING_UNSUB = (
+    "👋 Привет! Я бот для поиска авиабилетов.\n\n"
+    "📢 Для доступа к функциям бота необходимо подписаться на наш канал.\n\n"
+    "После подписки нажмите кнопку '✅ Я подписался'"
+)
+
+# Единый шаблон записи поиска/подписки в списках
+SEARCH_ROW_TEMPLATE = (
+    "ID: {id}\n"
+    "✈️ {origin} → {destination}\n"
+    "Цена: {price} ₽\n"
+    "Дата вылета: {departure_date}\n"
+    "Аэропорт отправления: {origin_airport}\n"
+    "Аэропорт прибытия: {destination_airport}\n"
+    "Пассажиров: {passengers}\n"
+    "[Ссылка]({ticket_link})"
+)
 
 class FlightSearch(StatesGroup):
     choosing_origin_country = State()
@@ -52,6 +121,14 @@ class FlightSearch(StatesGroup):
     choosing_transfers = State()
     choosing_date = State()
 
+# Структурированные callback-данные подписки вместо ручного split("_");
+# разделитель "|", потому что дата вылета содержит "HH:MM" с двоеточием
+class SubscribeCB(CallbackData, prefix="sub", sep="|"):
+    origin: str
+    destination: str
+    date: str
+    passengers: int
+
 # Страны СНГ с названиями
 CIS_COUNTRIES = [
     {"code": "RU", "name": "Россия"},
@@ -76,14 +153,25 @@ ALL_COUNTRIES = CIS_COUNTRIES + [
     {"code": "ES", "name": "Испания"}
 ]
 
+# Кэш результатов проверки подписки на канал: user_id -> (истекает, подписан)
+_sub_cache: dict = {}
+_SUB_CACHE_TTL = 60      # секунд для положительного ответа
+_SUB_CACHE_TTL_NEG = 10  # секунд для отрицательного
+
 async def check_channel_subscription(user_id: int) -> bool:
-    """Проверяет, подписан ли пользователь на канал"""
+    """Проверяет, подписан ли пользователь на канал (с коротким кэшем)"""
+    cached = _sub_cache.get(user_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
     try:
         member = await bot.get_chat_member(f"@{CHANNEL_USERNAME}", user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in ['member', 'administrator', 'creator']
     except Exception as e:
-        print(f"Ошибка проверки подписки: {e}")
+        logger.warning("Ошибка проверки подписки: %s", e)
         return False
+    ttl = _SUB_CACHE_TTL if is_member else _SUB_CACHE_TTL_NEG
+    _sub_cache[user_id] = (time.monotonic() + ttl, is_member)
+    return is_member
 
 async def require_subscription_check(user_id: int, message: types.Message = None, callback: types.CallbackQuery = None):
     """Проверяет подписку и показывает сообщение если не подписан"""
@@ -103,67 +191,106 @@ async def require_subscription_check(user_id: int, message: types.Message = None
     
     return False
 
+# Коды стран из статического списка (чтобы не пересобирать set на каждый вызов)
+_ALL_CODES = {c['code'] for c in ALL_COUNTRIES}
+
+# Кэш расширенного списка стран (отдельно для отправления/прибытия):
+# is_origin -> (истекает, список, словарь поиска). Как и у проверки подписки,
+# неудачный ответ API живёт в кэше заметно короче полного
+_extended_countries_cache: dict = {}
+_EXTENDED_COUNTRIES_TTL = 600     # секунд для полного списка
+_EXTENDED_COUNTRIES_TTL_NEG = 30  # секунд, если API не ответил
+
 async def get_extended_countries(is_origin: bool = False) -> list:
+    cached = _extended_countries_cache.get(is_origin)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
     api_countries = await get_countries()
-    api_country_dict = {c.code: c.name for c in api_countries}
     extended = ALL_COUNTRIES.copy()
-    for code, name in api_country_dict.items():
-        if not any(c['code'] == code for c in extended):
-            extended.append({"code": code, "name": name})
+    seen = set(_ALL_CODES)
+    for country in api_countries:
+        if country.code not in seen:
+            extended.append({"code": country.code, "name": country.name})
+            seen.add(country.code)
+    # Вместе со списком кэшируем словарь поиска по имени/коду в нижнем регистре
+    lookup = {}
+    for country in extended:
+        lookup[country['code'].lower()] = country
+        lookup[country['name'].lower()] = country
+    ttl = _EXTENDED_COUNTRIES_TTL if api_countries else _EXTENDED_COUNTRIES_TTL_NEG
+    _extended_countries_cache[is_origin] = (time.monotonic() + ttl, extended, lookup)
     return extended
 
 async def find_country_by_name_or_code(input_text: str, countries: list) -> dict:
     input_text = input_text.strip().lower()
+    for cached in _extended_countries_cache.values():
+        if cached[1] is countries:
+            return cached[2].get(input_text)
+    # Список не из кэша — остаётся линейный поиск
     for country in countries:
         if input_text == country['code'].lower() or input_text == country['name'].lower():
             return country
     return None
 
-def create_country_keyboard(countries: list, page: int = 0) -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=256)
+def _build_country_keyboard(countries_tuple: tuple, page: int) -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     start_idx = page * 4
-    end_idx = min(start_idx + 4, len(countries))
-    for country in countries[start_idx:end_idx]:
+    end_idx = min(start_idx + 4, len(countries_tuple))
+    for code, name in countries_tuple[start_idx:end_idx]:
         keyboard.inline_keyboard.append([InlineKeyboardButton(
-            text=country['name'],
-            callback_data=f"country_{country['code']}"
+            text=name,
+            callback_data=f"country_{code}"
         )])
     nav_buttons = []
     if page > 0:
         nav_buttons.append(InlineKeyboardButton(text="Назад", callback_data=f"prev_page_country_{page-1}"))
-    if end_idx < len(countries):
+    if end_idx < len(countries_tuple):
         nav_buttons.append(InlineKeyboardButton(text="Далее", callback_data=f"next_page_country_{page+1}"))
     if nav_buttons:
         keyboard.inline_keyboard.append(nav_buttons)
     keyboard.inline_keyboard.append([InlineKeyboardButton(text="В меню", callback_data="back_to_menu")])
     return keyboard
 
-def create_city_keyboard(cities: list, page: int = 0) -> InlineKeyboardMarkup:
+def create_country_keyboard(countries: list, page: int = 0) -> InlineKeyboardMarkup:
+    # Кортеж (код, имя) хэшируем — готовая клавиатура берётся из lru_cache
+    return _build_country_keyboard(tuple((c['code'], c['name']) for c in countries), page)
+
+@functools.lru_cache(maxsize=2048)
+def _build_city_keyboard(cities_tuple: tuple, page: int) -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     start_idx = page * 4
-    end_idx = min(start_idx + 4, len(cities))
-    for city in cities[start_idx:end_idx]:
+    end_idx = min(start_idx + 4, len(cities_tuple))
+    for code, name in cities_tuple[start_idx:end_idx]:
         keyboard.inline_keyboard.append([InlineKeyboardButton(
-            text=f"{city.name} ({city.code})",
-            callback_data=f"city_{city.code}"
+            text=f"{name} ({code})",
+            callback_data=f"city_{code}"
         )])
     nav_buttons = []
     if page > 0:
         nav_buttons.append(InlineKeyboardButton(text="Назад", callback_data=f"prev_page_city_{page-1}"))
-    if end_idx < len(cities):
+    if end_idx < len(cities_tuple):
         nav_buttons.append(InlineKeyboardButton(text="Далее", callback_data=f"next_page_city_{page+1}"))
     if nav_buttons:
         keyboard.inline_keyboard.append(nav_buttons)
     keyboard.inline_keyboard.append([InlineKeyboardButton(text="В меню", callback_data="back_to_menu")])
     return keyboard
 
+def create_city_keyboard(cities: list, page: int = 0) -> InlineKeyboardMarkup:
+    # Список городов страны после загрузки не меняется — страницы кэшируются
+    return _build_city_keyboard(tuple((c.code, c.name) for c in cities), page)
+
+# Парсинг дат недёшев, а одни и те же строки приходят постоянно — кэшируем
+@functools.lru_cache(maxsize=2048)
 def validate_date(date_str: str) -> bool:
+    # Строго %Y-%m-%d: fromisoformat пропускал бы YYYYMMDD и недельные даты
     try:
         datetime.strptime(date_str, "%Y-%m-%d")
         return True
     except ValueError:
         return False
 
+@functools.lru_cache(maxsize=2048)
 def format_date(iso_date: str) -> str:
     try:
         return datetime.fromisoformat(iso_date.replace("Z", "+00:00")).strftime("%d %B %Y, %H:%M")
@@ -172,46 +299,25 @@ def format_date(iso_date: str) -> str:
 
 @dp.message(Command("start"))
 async def start(message: types.Message, state: FSMContext):
-    print(f"Chat ID: {message.chat.id}")
+    logger.debug("Chat ID: %s", message.chat.id)
     await state.clear()
     
     if not await check_channel_subscription(message.from_user.id):
-        greeting_text = (
-            "👋 Привет! Я бот для поиска авиабилетов.\n\n"
-            "📢 Для доступа к функциям бота необходимо подписаться на наш канал.\n\n"
-            "После подписки нажмите кнопку '✅ Я подписался'"
-        )
-        await message.answer(greeting_text, reply_markup=get_channel_subscription_keyboard())
+        await message.answer(GREETING_UNSUB, reply_markup=get_channel_subscription_keyboard())
         return
-    
-    greeting_text = (
-        "👋 Привет! Я бот для поиска авиабилетов.\n\n"
-        "Вот что я умею:\n"
-        "✈️ Найти билеты по направлениям и дате вылета (включая пересадки)\n"
-        "💰 Подписаться на билеты и получать уведомления о снижении цены на 10% и более\n"
-        "📜 Просмотреть историю ваших поисков\n"
-        "📌 Посмотреть и управлять подписками\n\n"
-        "Выберите действие ниже, чтобы начать:"
-    )
-    await message.answer(greeting_text, reply_markup=get_main_menu())
 
-@dp.callback_query(lambda c: c.data == "check_subscription")
+    await message.answer(GREETING_SUBSCRIBED, reply_markup=get_main_menu())
+
+@dp.callback_query(F.data == "check_subscription")
 async def check_subscription_callback(callback: types.CallbackQuery, state: FSMContext):
+    # Пользователь говорит, что подписался — проверяем заново, минуя кэш
+    _sub_cache.pop(callback.from_user.id, None)
     if await check_channel_subscription(callback.from_user.id):
         await callback.message.edit_text(
             "✅ Отлично! Теперь вы можете использовать все функции бота.",
             reply_markup=None
         )
-        greeting_text = (
-            "👋 Привет! Я бот для поиска авиабилетов.\n\n"
-            "Вот что я умею:\n"
-            "✈️ Найти билеты по направлениям и дате вылета (включая пересадки)\n"
-            "💰 Подписаться на билеты и получать уведомления о снижении цены на 10% и более\n"
-            "📜 Просмотреть историю ваших поисков\n"
-            "📌 Посмотреть и управлять подписками\n\n"
-            "Выберите действие ниже, чтобы начать:"
-        )
-        await callback.message.answer(greeting_text, reply_markup=get_main_menu())
+        await callback.message.answer(GREETING_SUBSCRIBED, reply_markup=get_main_menu())
         await callback.answer()
     else:
         await callback.answer("❌ Вы еще не подписались на канал. Пожалуйста, подпишитесь и попробуйте снова.", show_alert=True)
@@ -223,20 +329,20 @@ async def unsubscribe(message: types.Message, state: FSMContext):
         
     try:
         sub_id = int(message.text.split()[1])
-        async with aiosqlite.connect("flights.db") as db:
-            cursor = await db.execute(
-                "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
-                (sub_id, message.chat.id)
-            )
-            result = await cursor.fetchone()
-            if not result:
-                await message.answer("❌ Подписка с таким ID не найдена.", reply_markup=get_main_menu())
-                return
-            await db.execute(
-                "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
-                (sub_id, message.chat.id)
-            )
-            await db.commit()
+        db = await get_db()
+        cursor = await db.execute(
+            "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
+            (sub_id, message.chat.id)
+        )
+        result = await cursor.fetchone()
+        if not result:
+            await message.answer("❌ Подписка с таким ID не найдена.", reply_markup=get_main_menu())
+            return
+        await db.execute(
+            "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
+            (sub_id, message.chat.id)
+        )
+        await db.commit()
         await message.answer(f"✅ Подписка {sub_id} удалена.", reply_markup=get_main_menu())
     except (IndexError, ValueError):
         await message.answer("Укажите ID подписки: /unsubscribe <id>", reply_markup=get_main_menu())
@@ -249,7 +355,7 @@ async def back_to_menu(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("Вы вернулись в главное меню:", reply_markup=get_main_menu())
 
-@dp.callback_query(lambda c: c.data == "back_to_menu")
+@dp.callback_query(F.data == "back_to_menu")
 async def back_to_menu_callback(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
@@ -283,22 +389,23 @@ async def start_subscription(message: types.Message, state: FSMContext):
         await message.answer("У вас нет истории поисков. Выберите страну отправления или введите название/код (например, Россия или RU):",
                             reply_markup=create_country_keyboard(countries))
         return
-    for search in searches:
-        response = (
-            f"ID: {search['id']}\n"
-            f"✈️ {search['origin']} → {search['destination']}\n"
-            f"Цена: {search['price']} ₽\n"
-            f"Дата вылета: {search['departure_date']}\n"
-            f"Аэропорт отправления: {search['origin_airport']}\n"
-            f"Аэропорт прибытия: {search['destination_airport']}\n"
-            f"Пассажиров: {search['passengers']}\n"
-            f"[Ссылка]({search['ticket_link']})\n"
-            f"Дата поиска: {search['created_at']}\n"
+    send_tasks = []
+    chunk_size = 10
+    for i in range(0, len(searches), chunk_size):
+        chunk = searches[i:i + chunk_size]
+        response = "\n\n".join(
+            SEARCH_ROW_TEMPLATE.format_map(search) + f"\nДата поиска: {search['created_at']}"
+            for search in chunk
         )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться", callback_data=f"subscribe_{search['origin']}_{search['destination']}_{search['departure_date']}_{search['passengers']}")]
+            [InlineKeyboardButton(text=f"Подписаться (ID {search['id']})",
+                                 callback_data=SubscribeCB(origin=search['origin'], destination=search['destination'],
+                                                           date=search['departure_date'], passengers=search['passengers']).pack())]
+            for search in chunk
         ])
-        await message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard)
+        send_tasks.append(safe_send(message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard),
+                                    chat_id=message.chat.id))
+    await asyncio.gather(*send_tasks)
     await message.answer("Или выберите новое направление:", reply_markup=create_country_keyboard(countries))
     await state.set_state(FlightSearch.choosing_origin_country)
 
@@ -311,23 +418,22 @@ async def list_subscriptions(message: types.Message, state: FSMContext):
     if not subscriptions:
         await message.answer("У вас нет активных подписок.", reply_markup=get_main_menu())
         return
-    for sub in subscriptions:
-        response = (
-            f"ID: {sub['id']}\n"
-            f"✈️ {sub['origin']} → {sub['destination']}\n"
-            f"Цена: {sub['price']} ₽\n"
-            f"Дата вылета: {sub['departure_date']}\n"
-            f"Аэропорт отправления: {sub['origin_airport']}\n"
-            f"Аэропорт прибытия: {sub['destination_airport']}\n"
-            f"Пассажиров: {sub['passengers']}\n"
-            f"[Ссылка]({sub['ticket_link']})\n"
-            f"Дата подписки: {sub['created_at']}\n"
+    send_tasks = []
+    chunk_size = 10
+    for i in range(0, len(subscriptions), chunk_size):
+        chunk = subscriptions[i:i + chunk_size]
+        response = "\n\n".join(
+            SEARCH_ROW_TEMPLATE.format_map(sub) + f"\nДата подписки: {sub['created_at']}"
+            for sub in chunk
         )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Отписаться", callback_data=f"unsubscribe_{sub['id']}")],
-            [InlineKeyboardButton(text="Обновить цену", callback_data=f"refresh_price_{sub['id']}")]
+            [InlineKeyboardButton(text=f"Отписаться {sub['id']}", callback_data=f"unsubscribe_{sub['id']}"),
+             InlineKeyboardButton(text=f"Обновить цену {sub['id']}", callback_data=f"refresh_price_{sub['id']}")]
+            for sub in chunk
         ])
-        await message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard)
+        send_tasks.append(safe_send(message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard),
+                                    chat_id=message.chat.id))
+    await asyncio.gather(*send_tasks)
     await message.answer("Выберите действие:", reply_markup=get_main_menu())
 
 @dp.message(F.text == "История поиска")
@@ -339,22 +445,21 @@ async def list_history(message: types.Message, state: FSMContext):
     if not searches:
         await message.answer("У вас нет истории поисков.", reply_markup=get_main_menu())
         return
-    for search in searches:
-        response = (
-            f"ID: {search['id']}\n"
-            f"✈️ {search['origin']} → {search['destination']}\n"
-            f"Цена: {search['price']} ₽\n"
-            f"Дата вылета: {search['departure_date']}\n"
-            f"Аэропорт отправления: {search['origin_airport']}\n"
-            f"Аэропорт прибытия: {search['destination_airport']}\n"
-            f"Пассажиров: {search['passengers']}\n"
-            f"[Ссылка]({search['ticket_link']})\n"
-            f"Дата поиска: {search['created_at']}\n"
+    send_tasks = []
+    chunk_size = 10
+    for i in range(0, len(searches), chunk_size):
+        chunk = searches[i:i + chunk_size]
+        response = "\n\n".join(
+            SEARCH_ROW_TEMPLATE.format_map(search) + f"\nДата поиска: {search['created_at']}"
+            for search in chunk
         )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Удалить", callback_data=f"delete_from_history_{search['id']}")]
+            [InlineKeyboardButton(text=f"Удалить {search['id']}", callback_data=f"delete_from_history_{search['id']}")]
+            for search in chunk
         ])
-        await message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard)
+        send_tasks.append(safe_send(message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard),
+                                    chat_id=message.chat.id))
+    await asyncio.gather(*send_tasks)
     await message.answer("Выберите действие:", reply_markup=get_main_menu())
 
 @dp.message(FlightSearch.choosing_origin_country)
@@ -369,7 +474,6 @@ async def process_origin_country_text(message: types.Message, state: FSMContext)
         await message.answer("❌ Страна не найдена. Введите название или код страны (например, Россия или RU):",
                             reply_markup=get_back_button())
         return
-    await state.update_data(origin_country=country['code'])
     await state.set_state(FlightSearch.choosing_origin_city)
     cities = await get_cities_by_country(country['code'], is_origin=True)
     if not cities:
@@ -377,6 +481,9 @@ async def process_origin_country_text(message: types.Message, state: FSMContext)
                             reply_markup=get_main_menu())
         await state.set_state(FlightSearch.choosing_origin_country)
         return
+    # Одно обращение к хранилищу состояния: страна и карта городов вместе
+    await state.update_data(origin_country=country['code'],
+                            origin_cities={c.code: c.name for c in cities})
     await message.answer(f"Вы выбрали страну отправления: {country['name']}\n"
                         "Выберите город отправления или введите код/название (например, Москва или MOW):",
                         reply_markup=create_city_keyboard(cities))
@@ -393,16 +500,17 @@ async def process_destination_country_text(message: types.Message, state: FSMCon
         await message.answer("❌ Страна не найдена. Введите название или код страны (например, Испания или ES):",
                             reply_markup=get_back_button())
         return
-    await state.update_data(destination_country=country['code'])
     await state.set_state(FlightSearch.choosing_destination_city)
-    
+
     cities = await get_cities_by_country(country['code'])
-    
+
     if not cities:
         await message.answer("❌ Нет доступных городов прибытия для этой страны. Попробуйте другую:",
                             reply_markup=get_main_menu())
         await state.set_state(FlightSearch.choosing_destination_country)
         return
+    await state.update_data(destination_country=country['code'],
+                            destination_cities={c.code: c.name for c in cities})
     await message.answer(f"Вы выбрали страну прибытия: {country['name']}\n"
                         "Выберите город прибытия или введите код/название (например, Мадрид или MAD):",
                         reply_markup=create_city_keyboard(cities))
@@ -415,11 +523,12 @@ async def process_origin_city_text(message: types.Message, state: FSMContext):
     input_text = message.text.strip()
     data = await state.get_data()
     country_code = data.get("origin_country")
-    cities = await get_cities_by_country(country_code, is_origin=True)
-    
+    # Карта городов сохранена на предыдущем шаге — повторный запрос не нужен
+    cities_map = data.get("origin_cities") or await get_city_index(country_code)
+
     if is_valid_iata_code(input_text.upper()):
-        city = next((c for c in cities if c.code == input_text.upper()), None)
-        if not city:
+        city_code = input_text.upper()
+        if city_code not in cities_map:
             await message.answer(f"❌ Код города {input_text.upper()} не найден в стране. Попробуйте снова (например, Москва или MOW):",
                                 reply_markup=get_back_button())
             return
@@ -429,11 +538,13 @@ async def process_origin_city_text(message: types.Message, state: FSMContext):
             await message.answer(f"❌ Город '{input_text}' не найден в стране. Попробуйте снова (например, Москва или MOW):",
                                 reply_markup=get_back_button())
             return
-    
-    await state.update_data(origin_city=city.code)
+        city_code = city.code
+
+    data['origin_city'] = city_code
+    await state.set_data(data)
     await state.set_state(FlightSearch.choosing_destination_country)
     countries = await get_extended_countries(is_origin=False)
-    await message.answer(f"Вы выбрали город отправления: {city.code}\n"
+    await message.answer(f"Вы выбрали город отправления: {city_code}\n"
                         "Выберите страну прибытия или введите название/код (например, Испания или ES):",
                         reply_markup=create_country_keyboard(countries))
 
@@ -445,12 +556,11 @@ async def process_destination_city(message: types.Message, state: FSMContext):
     input_text = message.text.strip()
     data = await state.get_data()
     country_code = data.get("destination_country")
-    
-    cities = await get_cities_by_country(country_code)
-    
+    cities_map = data.get("destination_cities") or await get_city_index(country_code)
+
     if is_valid_iata_code(input_text.upper()):
-        city = next((c for c in cities if c.code == input_text.upper()), None)
-        if not city:
+        city_code = input_text.upper()
+        if city_code not in cities_map:
             await message.answer(f"❌ Код города {input_text.upper()} не найден в стране. Попробуйте снова (например, Мадрид или MAD):",
                                 reply_markup=get_back_button())
             return
@@ -460,8 +570,10 @@ async def process_destination_city(message: types.Message, state: FSMContext):
             await message.answer(f"❌ Город '{input_text}' не найден в стране. Попробуйте снова (например, Мадрид или MAD):",
                                 reply_markup=get_back_button())
             return
-    
-    await state.update_data(destination_city=city.code)
+        city_code = city.code
+
+    data['destination_city'] = city_code
+    await state.set_data(data)
     await state.set_state(FlightSearch.choosing_passengers)
     await message.answer("Введите количество пассажиров (1–9):", reply_markup=get_back_button())
 
@@ -487,12 +599,12 @@ async def process_passengers(message: types.Message, state: FSMContext):
     ])
     await message.answer("Выберите количество пересадок:", reply_markup=keyboard)
 
-@dp.callback_query(lambda c: c.data.startswith("transfers_"))
+@dp.callback_query(F.data.startswith("transfers_"))
 async def process_transfers(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
         
-    transfers_str = callback.data.split("_")[1]
+    transfers_str = callback.data.removeprefix("transfers_")
     transfers = None if transfers_str == "any" else int(transfers_str)
     await state.update_data(transfers=transfers)
     await state.set_state(FlightSearch.choosing_date)
@@ -542,39 +654,44 @@ async def process_date(message: types.Message, state: FSMContext):
     try:
         await bot.delete_message(chat_id=message.chat.id, message_id=parsing_message.message_id)
     except Exception as e:
-        print(f"Ошибка удаления сообщения: {e}")
+        logger.debug("Ошибка удаления сообщения: %s", e)
+
+    # Пишем историю в БД параллельно с отправкой сообщений
+    db_task = asyncio.create_task(add_searches_bulk(
+        message.chat.id,
+        [(price.origin, price.destination, price.price, price.departure_date,
+          price.origin_airport, price.destination_airport, price.ticket_link, price.passengers)
+         for price in prices],
+        is_subscription=False
+    ))
 
+    send_tasks = []
     chunk_size = 5
     for i in range(0, len(prices), chunk_size):
         chunk = prices[i:i + chunk_size]
-        response = f"Доступные билеты из {origin_city} в {destination_city} на {departure_date} ({passengers} пассажиров, часть {i // chunk_size + 1}):\n\n"
+        parts = [f"Доступные билеты из {origin_city} в {destination_city} на {departure_date} ({passengers} пассажиров, часть {i // chunk_size + 1}):\n"]
         for price in chunk:
-            response += (
+            parts.append(
                 f"✈️ {price.origin} → {price.destination} ({'прямой' if price.transfers == 0 else f'с {price.transfers} пересадкой(ами)'})\n"
                 f"Цена: {price.price} ₽\n"
                 f"Дата вылета: {format_date(price.departure_date)}\n"
                 f"Аэропорт отправления: {price.origin_airport}\n"
                 f"Аэропорт прибытия: {price.destination_airport}\n"
                 f"Пассажиров: {price.passengers}\n"
-                f"[Ссылка]({price.ticket_link})\n\n"
-            )
-            await add_search(
-                message.chat.id,
-                price.origin,
-                price.destination,
-                price.price,
-                price.departure_date,
-                price.origin_airport,
-                price.destination_airport,
-                price.ticket_link,
-                price.passengers,
-                is_subscription=False
+                f"[Ссылка]({price.ticket_link})\n"
             )
+        response = "\n".join(parts)
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться на это направление", callback_data=f"subscribe_{origin_city}_{destination_city}_{departure_date}_{passengers}")]
+            [InlineKeyboardButton(text="Подписаться на это направление",
+                                 callback_data=SubscribeCB(origin=origin_city, destination=destination_city,
+                                                           date=departure_date, passengers=passengers).pack())]
         ])
-        await message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard)
+        send_tasks.append(safe_send(message.answer(response, parse_mode="Markdown", disable_web_page_preview=True, reply_markup=keyboard),
+                                    chat_id=message.chat.id))
+
+    await asyncio.gather(*send_tasks)
+    await db_task
 
     if is_subscription:
         price = prices[0]
@@ -600,7 +717,7 @@ async def process_date(message: types.Message, state: FSMContext):
 
     await state.clear()
 
-@dp.callback_query(lambda c: c.data.startswith("country_") or c.data.startswith("next_page_country_") or c.data.startswith("prev_page_country_"))
+@dp.callback_query(F.data.startswith("country_") | F.data.startswith("next_page_country_") | F.data.startswith("prev_page_country_"))
 async def process_country_selection(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
@@ -610,7 +727,7 @@ async def process_country_selection(callback: types.CallbackQuery, state: FSMCon
     countries = await get_extended_countries(is_origin=(current_state == FlightSearch.choosing_origin_country.state))
 
     if callback.data.startswith("next_page_country_") or callback.data.startswith("prev_page_country_"):
-        page = int(callback.data.split("_")[-1])
+        page = int(callback.data.rpartition("_")[2])
         if current_state == FlightSearch.choosing_origin_country.state:
             await callback.message.edit_text("Выберите страну отправления или введите название/код (например, Россия или RU):",
                                             reply_markup=create_country_keyboard(countries, page))
@@ -620,14 +737,15 @@ async def process_country_selection(callback: types.CallbackQuery, state: FSMCon
         await callback.answer()
         return
 
-    country_code = callback.data.split("_")[1]
-    if not any(c['code'] == country_code for c in countries):
+    country_code = callback.data.removeprefix("country_")
+    country = await find_country_by_name_or_code(country_code, countries)
+    if not country:
         await callback.message.answer("❌ Неверная страна. Попробуйте снова:", reply_markup=get_inline_menu_button())
         await callback.answer()
         return
+    country_name = country['name']
 
     if current_state == FlightSearch.choosing_origin_country.state:
-        await state.update_data(origin_country=country_code)
         await state.set_state(FlightSearch.choosing_origin_city)
         cities = await get_cities_by_country(country_code, is_origin=True)
         if not cities:
@@ -638,16 +756,17 @@ async def process_country_selection(callback: types.CallbackQuery, state: FSMCon
                                             reply_markup=create_country_keyboard(countries))
             await callback.answer()
             return
-        country_name = next((c['name'] for c in countries if c['code'] == country_code), country_code)
+        data['origin_country'] = country_code
+        data['origin_cities'] = {c.code: c.name for c in cities}
+        await state.set_data(data)
         await callback.message.edit_text(f"Вы выбрали страну отправления: {country_name}\n"
                                         "Выберите город отправления или введите код/название (например, Москва или MOW):",
                                         reply_markup=create_city_keyboard(cities))
     else:
-        await state.update_data(destination_country=country_code)
         await state.set_state(FlightSearch.choosing_destination_city)
-        
+
         cities = await get_cities_by_country(country_code)
-        
+
         if not cities:
             await callback.message.answer("❌ Нет доступных городов прибытия для этой страны. Попробуйте другую:",
                                         reply_markup=get_inline_menu_button())
@@ -656,13 +775,15 @@ async def process_country_selection(callback: types.CallbackQuery, state: FSMCon
                                             reply_markup=create_country_keyboard(countries))
             await callback.answer()
             return
-        country_name = next((c['name'] for c in countries if c['code'] == country_code), country_code)
+        data['destination_country'] = country_code
+        data['destination_cities'] = {c.code: c.name for c in cities}
+        await state.set_data(data)
         await callback.message.edit_text(f"Вы выбрали страну прибытия: {country_name}\n"
                                         "Выберите город прибытия или введите код/название (например, Мадрид или MAD):",
                                         reply_markup=create_city_keyboard(cities))
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("city_") or c.data.startswith("next_page_city_") or c.data.startswith("prev_page_city_"))
+@dp.callback_query(F.data.startswith("city_") | F.data.startswith("next_page_city_") | F.data.startswith("prev_page_city_"))
 async def process_city_selection(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
@@ -671,7 +792,7 @@ async def process_city_selection(callback: types.CallbackQuery, state: FSMContex
     current_state = await state.get_state()
 
     if callback.data.startswith("next_page_city_") or callback.data.startswith("prev_page_city_"):
-        page = int(callback.data.split("_")[-1])
+        page = int(callback.data.rpartition("_")[2])
         if current_state == FlightSearch.choosing_origin_city.state:
             country_code = data.get("origin_country")
             cities = await get_cities_by_country(country_code, is_origin=True)
@@ -685,59 +806,74 @@ async def process_city_selection(callback: types.CallbackQuery, state: FSMContex
         await callback.answer()
         return
 
-    city_code = callback.data.split("_")[1]
+    city_code = callback.data.removeprefix("city_")
     if current_state == FlightSearch.choosing_origin_city.state:
-        cities = await get_cities_by_country(data.get("origin_country"), is_origin=True)
+        cities_map = data.get("origin_cities") or await get_city_index(data.get("origin_country"))
     else:
-        cities = await get_cities_by_country(data.get("destination_country"))
-    if not any(c.code == city_code for c in cities):
+        cities_map = data.get("destination_cities") or await get_city_index(data.get("destination_country"))
+    if city_code not in cities_map:
         await callback.message.answer("❌ Неверный код города. Попробуйте снова:", reply_markup=get_inline_menu_button())
         await callback.answer()
         return
 
     if current_state == FlightSearch.choosing_origin_city.state:
-        await state.update_data(origin_city=city_code)
+        data['origin_city'] = city_code
+        await state.set_data(data)
         await state.set_state(FlightSearch.choosing_destination_country)
         countries = await get_extended_countries(is_origin=False)
         await callback.message.edit_text(f"Вы выбрали город отправления: {city_code}\n"
                                         "Выберите страну прибытия или введите название/код (например, Испания или ES):",
                                         reply_markup=create_country_keyboard(countries))
     else:
-        await state.update_data(destination_city=city_code)
+        data['destination_city'] = city_code
+        await state.set_data(data)
         await state.set_state(FlightSearch.choosing_passengers)
         try:
             await callback.message.delete()
         except Exception as e:
-            print(f"Ошибка удаления сообщения: {e}")
+            logger.debug("Ошибка удаления сообщения: %s", e)
         await callback.message.answer("Введите количество пассажиров (1–9):",
                                      reply_markup=get_back_button())
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("subscribe_"))
-async def subscribe_direction(callback: types.CallbackQuery, state: FSMContext):
+# Защита от "дятла": повторные нажатия одной кнопки в течение секунды
+# не должны порождать дублирующие запросы к API и записи в БД
+_last_click: dict = {}
+_CLICK_DEBOUNCE = 1.0
+
+def _is_duplicate_click(callback: types.CallbackQuery) -> bool:
+    key = (callback.from_user.id, callback.data)
+    now = time.monotonic()
+    if now - _last_click.get(key, 0) < _CLICK_DEBOUNCE:
+        return True
+    _last_click[key] = now
+    return False
+
+@dp.callback_query(SubscribeCB.filter())
+async def subscribe_direction(callback: types.CallbackQuery, callback_data: SubscribeCB, state: FSMContext):
+    if _is_duplicate_click(callback):
+        await callback.answer("⏳ Обрабатываю...")
+        return
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
-        
-    try:
-        _, origin, destination, departure_date, passengers = callback.data.split("_")
-        passengers = int(passengers)
-    except ValueError:
-        await callback.message.answer("❌ Ошибка обработки подписки. Попробуйте снова.", reply_markup=get_main_menu())
+
+    origin = callback_data.origin
+    destination = callback_data.destination
+    departure_date = callback_data.date
+    passengers = callback_data.passengers
+
+    db = await get_db()
+    cursor = await db.execute(
+        "SELECT id FROM searches WHERE chat_id = ? AND origin = ? AND destination = ? AND departure_date = ? AND passengers = ? AND is_subscription = 1",
+        (callback.message.chat.id, origin, destination, departure_date, passengers)
+    )
+    if await cursor.fetchone():
+        await callback.message.answer(f"❌ Вы уже подписаны на направление {origin} → {destination} на {departure_date}.",
+                                    reply_markup=get_main_menu())
+        await callback.message.edit_reply_markup(reply_markup=None)
         await callback.answer()
         return
 
-    async with aiosqlite.connect("flights.db") as db:
-        cursor = await db.execute(
-            "SELECT id FROM searches WHERE chat_id = ? AND origin = ? AND destination = ? AND departure_date = ? AND passengers = ? AND is_subscription = 1",
-            (callback.message.chat.id, origin, destination, departure_date, passengers)
-        )
-        if await cursor.fetchone():
-            await callback.message.answer(f"❌ Вы уже подписаны на направление {origin} → {destination} на {departure_date}.",
-                                        reply_markup=get_main_menu())
-            await callback.message.edit_reply_markup(reply_markup=None)
-            await callback.answer()
-            return
-
     prices = await get_flights_for_date(origin, destination, departure_date, passengers, max_transfers=None)
     if not prices:
         await callback.message.answer(f"❌ Не удалось найти билеты для {origin} → {destination} на {departure_date}.",
@@ -767,78 +903,81 @@ async def subscribe_direction(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("delete_from_history_"))
+@dp.callback_query(F.data.startswith("delete_from_history_"))
 async def delete_from_history(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
         
-    search_id = int(callback.data.split("_")[-1])
-    async with aiosqlite.connect("flights.db") as db:
-        cursor = await db.execute(
-            "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 0",
-            (search_id, callback.message.chat.id)
-        )
-        result = await cursor.fetchone()
-        if not result:
-            await callback.message.answer("❌ Запись поиска не найдена.", reply_markup=get_main_menu())
-            await callback.answer()
-            return
-        await db.execute(
-            "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 0",
-            (search_id, callback.message.chat.id)
-        )
-        await db.commit()
+    search_id = int(callback.data.rpartition("_")[2])
+    db = await get_db()
+    cursor = await db.execute(
+        "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 0",
+        (search_id, callback.message.chat.id)
+    )
+    result = await cursor.fetchone()
+    if not result:
+        await callback.message.answer("❌ Запись поиска не найдена.", reply_markup=get_main_menu())
+        await callback.answer()
+        return
+    await db.execute(
+        "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 0",
+        (search_id, callback.message.chat.id)
+    )
+    await db.commit()
     await callback.message.edit_text("✅ Запись поиска удалена.")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("unsubscribe_"))
+@dp.callback_query(F.data.startswith("unsubscribe_"))
 async def unsubscribe_callback(callback: types.CallbackQuery, state: FSMContext):
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
         
-    sub_id = int(callback.data.split("_")[1])
-    async with aiosqlite.connect("flights.db") as db:
-        cursor = await db.execute(
-            "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
-            (sub_id, callback.message.chat.id)
-        )
-        result = await cursor.fetchone()
-        if not result:
-            await callback.message.answer("❌ Подписка с таким ID не найдена.", reply_markup=get_main_menu())
-            await callback.answer()
-            return
-        await db.execute(
-            "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
-            (sub_id, callback.message.chat.id)
-        )
-        await db.commit()
+    sub_id = int(callback.data.removeprefix("unsubscribe_"))
+    db = await get_db()
+    cursor = await db.execute(
+        "SELECT id FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
+        (sub_id, callback.message.chat.id)
+    )
+    result = await cursor.fetchone()
+    if not result:
+        await callback.message.answer("❌ Подписка с таким ID не найдена.", reply_markup=get_main_menu())
+        await callback.answer()
+        return
+    await db.execute(
+        "DELETE FROM searches WHERE id = ? AND chat_id = ? AND is_subscription = 1",
+        (sub_id, callback.message.chat.id)
+    )
+    await db.commit()
     await callback.message.edit_text(f"✅ Подписка {sub_id} удалена.")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("refresh_price_"))
+@dp.callback_query(F.data.startswith("refresh_price_"))
 async def refresh_price_callback(callback: types.CallbackQuery, state: FSMContext):
+    if _is_duplicate_click(callback):
+        await callback.answer("⏳ Обрабатываю...")
+        return
     if not await require_subscription_check(callback.from_user.id, callback=callback):
         return
-        
-    search_id = int(callback.data.split("_")[-1])
-    async with aiosqlite.connect("flights.db") as db:
-        cursor = await db.execute(
-            "SELECT origin, destination, departure_date, passengers, is_subscription FROM searches WHERE id = ? AND chat_id = ?",
-            (search_id, callback.message.chat.id)
-        )
-        result = await cursor.fetchone()
-        if not result:
-            await callback.message.answer("❌ Запись не найдена.", reply_markup=get_main_menu())
-            await callback.answer()
-            return
-        origin, destination, departure_date, passengers, is_subscription = result
-        search = {
-            "origin": origin,
-            "destination": destination,
-            "departure_date": departure_date,
-            "passengers": passengers,
-            "is_subscription": is_subscription
-        }
+
+    search_id = int(callback.data.rpartition("_")[2])
+    db = await get_db()
+    cursor = await db.execute(
+        "SELECT origin, destination, departure_date, passengers, is_subscription FROM searches WHERE id = ? AND chat_id = ?",
+        (search_id, callback.message.chat.id)
+    )
+    result = await cursor.fetchone()
+    if not result:
+        await callback.message.answer("❌ Запись не найдена.", reply_markup=get_main_menu())
+        await callback.answer()
+        return
+    origin, destination, departure_date, passengers, is_subscription = result
+    search = {
+        "origin": origin,
+        "destination": destination,
+        "departure_date": departure_date,
+        "passengers": passengers,
+        "is_subscription": is_subscription
+    }
     flights = await get_flights_for_date(origin, destination, departure_date, passengers, max_transfers=None)
     if not flights:
         await callback.message.edit_text("❌ Не удалось обновить цену. Попробуйте позже.")
@@ -881,17 +1020,47 @@ async def refresh_price_callback(callback: types.CallbackQuery, state: FSMContex
 async def check_prices_loop():
     while True:
         try:
+            # Заодно чистим устаревшие записи антидребезга кнопок
+            # и протухшие записи кэша подписки на канал
+            cutoff = time.monotonic() - _CLICK_DEBOUNCE
+            for key in [k for k, ts in _last_click.items() if ts < cutoff]:
+                del _last_click[key]
+            now = time.monotonic()
+            for user_id in [u for u, (expires, _) in _sub_cache.items() if expires < now]:
+                del _sub_cache[user_id]
+            for chat in [c for c, slot in _chat_send_at.items() if slot < now]:
+                del _chat_send_at[chat]
+            prune_flights_cache()
+
             searches = await get_all_searches()
-            for s in searches:
+
+            # Подписку на канал проверяем один раз на чат за итерацию;
+            # некэшированные чаты проверяются параллельно, но не больше 20 разом —
+            # TTL кэша короче интервала цикла, так что каждая итерация идёт в API
+            sem = asyncio.Semaphore(20)
+
+            async def check_member(c):
+                async with sem:
+                    return await check_channel_subscription(c)
+
+            chat_ids = list({s["chat_id"] for s in searches})
+            statuses = await asyncio.gather(*[check_member(c) for c in chat_ids])
+            members = dict(zip(chat_ids, statuses))
+
+            # Запросы цен независимы — пускаем их параллельно под тем же лимитом.
+            # Найденные снижения пишем в БД одной транзакцией после gather,
+            # а не отдельным commit на каждую подписку
+            price_updates = []
+
+            async def handle(s):
                 search_id, chat_id, origin, destination, last_price, departure_date, origin_airport, destination_airport, ticket_link, passengers, is_subscription, created_at = s
+                if not members.get(chat_id):
+                    return
                 try:
-                    # Проверяем подписку пользователя перед отправкой уведомления
-                    if not await check_channel_subscription(chat_id):
-                        continue
-                        
-                    flights = await get_flights_for_date(origin, destination, departure_date, passengers, max_transfers=None)
+                    async with sem:
+                        flights = await get_flights_for_date(origin, destination, departure_date, passengers, max_transfers=None)
                     if flights and flights[0].price < last_price * 0.9:
-                        await bot.send_message(
+                        await safe_send(bot.send_message(
                             chat_id,
                             f"💸 Цена на {origin} → {destination} ({'прямой' if flights[0].transfers == 0 else f'с {flights[0].transfers} пересадкой(ами)'})\n"
                             f"снизилась на {int((1 - flights[0].price / last_price) * 100)}%!\n"
@@ -903,23 +1072,35 @@ async def check_prices_loop():
                             f"[Ссылка]({flights[0].ticket_link})",
                             parse_mode="Markdown",
                             disable_web_page_preview=True
-                        )
-                        await update_price(
-                            search_id,
+                        ), chat_id=chat_id)
+                        price_updates.append((
                             flights[0].price,
                             flights[0].departure_date,
                             flights[0].origin_airport,
                             flights[0].destination_airport,
                             flights[0].ticket_link,
-                            flights[0].passengers
-                        )
-                except aiohttp.ClientError:
-                    pass
+                            flights[0].passengers,
+                            search_id
+                        ))
+                except Exception as e:
+                    # Обычное дело: пользователь заблокировал бота и send_message
+                    # кидает TelegramForbiddenError — остальных это не касается
+                    logger.warning("Ошибка проверки подписки %s: %s", search_id, e)
+
+            try:
+                # return_exceptions: даже неожиданный сбой одной задачи не должен
+                # бросить gather, оставив остальные задачи работать без присмотра
+                await asyncio.gather(*[handle(s) for s in searches], return_exceptions=True)
+            finally:
+                # Уже разосланные уведомления должны зафиксировать новую цену,
+                # даже если часть задач упала — иначе их будет слать повторно
+                await update_prices_bulk(price_updates)
         except Exception:
             pass
         await asyncio.sleep(CHECK_INTERVAL)
 
 async def main():
+    logging.basicConfig(level=logging.INFO)
     await init_db()
     asyncio.create_task(check_prices_loop())
     await dp.start_polling(bot)
@@ -1,67 +1,176 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
 import aiosqlite
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Одно соединение на всё время работы бота: connect() на каждый запрос
+# заново открывает файл и гоняет PRAGMA, что заметно дороже самих запросов
+_db: Optional[aiosqlite.Connection] = None
+
+async def get_db() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        _db = await aiosqlite.connect("flights.db")
+        _db.row_factory = aiosqlite.Row
+        # WAL позволяет читать и писать одновременно, NORMAL снижает цену fsync
+        await _db.execute("PRAGMA journal_mode=WAL")
+        await _db.execute("PRAGMA synchronous=NORMAL")
+        await _db.execute("PRAGMA cache_size=-20000")
+        await _db.execute("PRAGMA temp_store=memory")
+        await _db.execute("PRAGMA busy_timeout=5000")
+    return _db
+
+# Пул соединений только для чтения: под WAL читатели работают параллельно
+# с единственным писателем (get_db) и не ловят SQLITE_BUSY
+_read_pool: Optional[asyncio.Queue] = None
+_read_pool_lock = asyncio.Lock()
+_READ_POOL_SIZE = max(2, os.cpu_count() or 2)
+
+async def _get_read_pool() -> asyncio.Queue:
+    global _read_pool
+    if _read_pool is None:
+        # Без замка два первых читателя открыли бы по пулу каждый,
+        # и проигравший бросил бы свои соединения открытыми
+        async with _read_pool_lock:
+            if _read_pool is None:
+                pool = asyncio.Queue()
+                for _ in range(_READ_POOL_SIZE):
+                    conn = await aiosqlite.connect("file:flights.db?mode=ro", uri=True)
+                    conn.row_factory = aiosqlite.Row
+                    await conn.execute("PRAGMA busy_timeout=5000")
+                    pool.put_nowait(conn)
+                _read_pool = pool
+    return _read_pool
+
+@asynccontextmanager
+async def acquire_read():
+    """Выдаёт соединение из пула читателей на время блока."""
+    pool = await _get_read_pool()
+    conn = await pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put_nowait(conn)
+
+async def close_db():
+    global _db, _read_pool
+    if _db is not None:
+        await _db.execute("PRAGMA optimize")
+        await _db.close()
+        _db = None
+    if _read_pool is not None:
+        while not _read_pool.empty():
+            conn = _read_pool.get_nowait()
+            await conn.close()
+        _read_pool = None
 
 async def init_db():
-    async with aiosqlite.connect("flights.db") as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS searches (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                origin TEXT,
-                destination TEXT,
-                price INTEGER,
-                departure_date TEXT,
-                origin_airport TEXT,
-                destination_airport TEXT,
-                ticket_link TEXT,
-                passengers INTEGER,
-                is_subscription BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
-        print("Database initialized")
+    db = await get_db()
+    # Одним скриптом: таблица, индекс для выборок по чату и индекс,
+    # покрывающий проверку дубликата подписки в subscribe_direction
+    await db.executescript("""
+        CREATE TABLE IF NOT EXISTS searches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            origin TEXT,
+            destination TEXT,
+            price INTEGER,
+            departure_date TEXT,
+            origin_airport TEXT,
+            destination_airport TEXT,
+            ticket_link TEXT,
+            passengers INTEGER,
+            is_subscription BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_searches_chat_sub
+        ON searches(chat_id, is_subscription, id);
+        CREATE INDEX IF NOT EXISTS idx_searches_dup
+        ON searches(chat_id, origin, destination, departure_date, passengers, is_subscription);
+    """)
+    await db.commit()
+    logger.info("Database initialized")
 
 async def add_search(chat_id: int, origin: str, destination: str, price: int, departure_date: str,
                     origin_airport: str, destination_airport: str, ticket_link: str, passengers: int,
                     is_subscription: bool = False):
-    async with aiosqlite.connect("flights.db") as db:
-        await db.execute("""
-            INSERT INTO searches (chat_id, origin, destination, price, departure_date,
-                                 origin_airport, destination_airport, ticket_link, passengers, is_subscription)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (chat_id, origin, destination, price, departure_date, origin_airport,
-              destination_airport, ticket_link, passengers, is_subscription))
-        await db.commit()
-        print(f"Added {'subscription' if is_subscription else 'search'} for {origin}-{destination}, chat_id: {chat_id}")
+    db = await get_db()
+    await db.execute("""
+        INSERT INTO searches (chat_id, origin, destination, price, departure_date,
+                             origin_airport, destination_airport, ticket_link, passengers, is_subscription)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (chat_id, origin, destination, price, departure_date, origin_airport,
+          destination_airport, ticket_link, passengers, is_subscription))
+    await db.commit()
+    logger.debug("Added %s for %s-%s, chat_id: %s",
+                 "subscription" if is_subscription else "search", origin, destination, chat_id)
+
+async def add_searches_bulk(chat_id: int, price_rows: list, is_subscription: bool = False):
+    """Вставляет несколько записей поиска одной транзакцией.
+
+    price_rows — список кортежей (origin, destination, price, departure_date,
+    origin_airport, destination_airport, ticket_link, passengers).
+    """
+    if not price_rows:
+        return
+    rows = [(chat_id, *row, is_subscription) for row in price_rows]
+    db = await get_db()
+    await db.executemany("""
+        INSERT INTO searches (chat_id, origin, destination, price, departure_date,
+                             origin_airport, destination_airport, ticket_link, passengers, is_subscription)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    await db.commit()
+    logger.debug("Added %d %s for chat_id: %s",
+                 len(rows), "subscriptions" if is_subscription else "searches", chat_id)
 
 async def get_all_searches():
-    async with aiosqlite.connect("flights.db") as db:
-        db.row_factory = aiosqlite.Row
+    async with acquire_read() as db:
         async with db.execute("SELECT * FROM searches WHERE is_subscription = 1") as cursor:
             searches = await cursor.fetchall()
             return searches
 
 async def get_user_searches(chat_id: int):
-    async with aiosqlite.connect("flights.db") as db:
-        db.row_factory = aiosqlite.Row
+    async with acquire_read() as db:
         async with db.execute("SELECT * FROM searches WHERE chat_id = ? AND is_subscription = 0 ORDER BY created_at DESC",
                              (chat_id,)) as cursor:
             return await cursor.fetchall()
 
 async def get_user_subscriptions(chat_id: int):
-    async with aiosqlite.connect("flights.db") as db:
-        db.row_factory = aiosqlite.Row
+    async with acquire_read() as db:
         async with db.execute("SELECT * FROM searches WHERE chat_id = ? AND is_subscription = 1 ORDER BY created_at DESC",
                              (chat_id,)) as cursor:
             return await cursor.fetchall()
 
 async def update_price(search_id: int, price: int, departure_date: str, origin_airport: str,
                       destination_airport: str, ticket_link: str, passengers: int):
-    async with aiosqlite.connect("flights.db") as db:
-        await db.execute("""
-            UPDATE searches
-            SET price = ?, departure_date = ?, origin_airport = ?, destination_airport = ?, ticket_link = ?, passengers = ?
-            WHERE id = ?
-        """, (price, departure_date, origin_airport, destination_airport, ticket_link, passengers, search_id))
-        await db.commit()
-        print(f"Updated price for search_id {search_id} to {price}")
\ No newline at end of file
+    db = await get_db()
+    await db.execute("""
+        UPDATE searches
+        SET price = ?, departure_date = ?, origin_airport = ?, destination_airport = ?, ticket_link = ?, passengers = ?
+        WHERE id = ?
+    """, (price, departure_date, origin_airport, destination_airport, ticket_link, passengers, search_id))
+    await db.commit()
+    logger.debug("Updated price for search_id %s to %s", search_id, price)
+
+async def update_prices_bulk(rows: list):
+    """Обновляет несколько записей одним executemany и одним commit.
+
+    rows — список кортежей (price, departure_date, origin_airport,
+    destination_airport, ticket_link, passengers, search_id).
+    """
+    if not rows:
+        return
+    db = await get_db()
+    await db.executemany("""
+        UPDATE searches
+        SET price = ?, departure_date = ?, origin_airport = ?, destination_airport = ?, ticket_link = ?, passengers = ?
+        WHERE id = ?
+    """, rows)
+    await db.commit()
+    logger.debug("Updated prices for %d searches", len(rows))
@@ -1,22 +1,36 @@
 import aiohttp
+import asyncio
 import certifi
+import json
+import logging
+import os
+import re
 import ssl
+import time
 from typing import List, Optional, Dict
 from datetime import datetime
 from config import TRAVELPAYOUTS_TOKEN
-from pydantic import BaseModel, ValidationError
+from dataclasses import dataclass, field
 
-class City(BaseModel):
+logger = logging.getLogger(__name__)
+
+# Обычные слотовые датаклассы: полей немного, кросс-валидация не нужна,
+# а создание тысяч City при загрузке cities.json через pydantic заметно дороже
+
+@dataclass(slots=True, frozen=True)
+class City:
     code: str
     name: str
     country_code: str
-    cases: dict = {}
+    cases: dict = field(default_factory=dict)
 
-class Country(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Country:
     code: str
     name: str
 
-class FlightPrice(BaseModel):
+@dataclass(slots=True, frozen=True)
+class FlightPrice:
     origin: str
     destination: str
     price: int
@@ -32,8 +46,41 @@ _cities_cache: Optional[List[City]] = None
 _countries_cache: Optional[List[Country]] = None
 _directions_cache: Dict[str, List[str]] = {}
 
+# Индексы по городам, заполняются один раз при загрузке cities.json
+_cities_by_country: Dict[str, List[City]] = {}
+_cities_by_code: Dict[str, City] = {}
+_cities_by_name_lc: Dict[tuple, City] = {}
+
+# SSL-контекст создаётся один раз при импорте — загрузка CA-файла недешёвая
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+# Общая HTTP-сессия на всё время работы бота (переиспользует TCP/TLS-соединения)
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            ssl=_SSL_CONTEXT,
+            limit=100,
+            limit_per_host=30,
+            keepalive_timeout=75,
+            ttl_dns_cache=300
+        ))
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+# Функция горячая при загрузке cities.json (~10k вызовов):
+# один вызов скомпилированного regex быстрее цепочки из четырёх проверок
+_IATA_RE = re.compile(r"^[A-Z]{3}\Z").match
+
 def is_valid_iata_code(code: str) -> bool:
-    return len(code) == 3 and code.isupper() and code.isalpha() and code.isascii()
+    return _IATA_RE(code) is not None
 
 def normalize_date(date_str: str) -> str:
     """Normalize ISO date (e.g., 2025-10-17T21:50:00+03:00) to YYYY-MM-DD."""
@@ -43,81 +90,149 @@ def normalize_date(date_str: str) -> str:
     except ValueError:
         return date_str
 
-def normalize_datetime(date_str: str) -> str:
-    """Возвращает дату и время в формате YYYY-MM-DD HH:MM"""
+def generate_aviasales_link(origin: str, destination: str, departure: datetime, passengers: int) -> str:
+    """Генерирует ссылку на Aviasales с нужным количеством пассажиров."""
+    ddmm = departure.strftime("%d%m")
+    return f"https://www.aviasales.ru/search/{origin}{ddmm}{destination}{passengers}"
+
+# Справочники городов/стран меняются редко — держим копию на диске,
+# чтобы не скачивать ~2МБ cities.json на каждый холодный старт
+_CITIES_CACHE_FILE = "cities.json.cache"
+_COUNTRIES_CACHE_FILE = "countries.json.cache"
+_REFERENCE_CACHE_MAX_AGE = 24 * 3600  # секунд
+
+def _read_reference_cache(path: str):
     try:
-        dt = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
-        return dt.strftime("%Y-%m-%d %H:%M")
-    except ValueError:
-        return date_str
+        if time.time() - os.path.getmtime(path) < _REFERENCE_CACHE_MAX_AGE:
+            with open(path, "rb") as f:
+                return json.loads(f.read())
+    except (OSError, ValueError):
+        pass
+    return None
 
-def generate_aviasales_link(origin: str, destination: str, departure_date: str, passengers: int) -> str:
-    """
-    Генерирует ссылку на Aviasales с нужным количеством пассажиров.
-    departure_date: формат YYYY-MM-DD
-    """
+def _write_reference_cache(path: str, raw: bytes):
     try:
-        dt = datetime.strptime(departure_date[:10], "%Y-%m-%d")
-    except ValueError:
-        return ""
-    
-    ddmm = dt.strftime("%d%m")
-    return f"https://www.aviasales.ru/search/{origin}{ddmm}{destination}{passengers}"
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Не удалось сохранить кэш %s: %s", path, e)
+
+async def _fetch_reference_json(url: str, cache_path: str):
+    """Возвращает справочник из дискового кэша или скачивает и кэширует его."""
+    data = _read_reference_cache(cache_path)
+    if data is not None:
+        return data
+    session = get_http_session()
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            logger.error("Ошибка API (%s): %s - %s", url, resp.status, await resp.text())
+            return None
+        raw = await resp.read()
+        data = json.loads(raw)
+        _write_reference_cache(cache_path, raw)
+        return data
+
+# Первую загрузку городов держим под замком: два конкурирующих вызова
+# построили бы индексы дважды и задублировали каждый город
+_cities_lock = asyncio.Lock()
 
 async def _load_cities() -> List[City]:
     global _cities_cache
     if _cities_cache is not None:
         return _cities_cache
-    url = "https://api.travelpayouts.com/data/ru/cities.json"
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
+    async with _cities_lock:
+        if _cities_cache is not None:
+            return _cities_cache
+        url = "https://api.travelpayouts.com/data/ru/cities.json"
         try:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    print(f"Ошибка API (города): {resp.status} - {await resp.text()}")
-                    return []
-                data = await resp.json()
-                if not isinstance(data, list):
-                    print(f"Ошибка: cities.json не является списком, получен {type(data)}")
-                    return []
-                cities = []
-                for c in data:
-                    code = c.get("code", "").upper()
-                    if is_valid_iata_code(code) and c.get("cases"):
-                        cities.append(City(
-                            code=code,
-                            name=c["name"],
-                            country_code=c["country_code"],
-                            cases=c.get("cases", {})
-                        ))
-                _cities_cache = cities
-                return cities
+            data = await _fetch_reference_json(url, _CITIES_CACHE_FILE)
+            if data is None:
+                return []
+            if not isinstance(data, list):
+                logger.error("Ошибка: cities.json не является списком, получен %s", type(data))
+                return []
+            # Потребляем список деструктивно: каждый разобранный dict
+            # освобождается сразу после конвертации в City, чтобы ~10k сырых
+            # словарей и готовые объекты не жили в памяти одновременно.
+            # Порядок не важен — _build_city_indexes всё равно пересортирует.
+            cities = []
+            while data:
+                c = data.pop()
+                code = c.get("code", "").upper()
+                if is_valid_iata_code(code) and c.get("cases"):
+                    cities.append(City(
+                        code=code,
+                        name=c["name"],
+                        country_code=c["country_code"],
+                        cases=c.get("cases", {})
+                    ))
+            _build_city_indexes(cities)
+            _cities_cache = cities
+            return cities
         except aiohttp.ClientError as e:
-            print(f"Ошибка сети при получении городов: {e}")
+            logger.error("Ошибка сети при получении городов: %s", e)
             return []
 
+# Список популярных городов для разных стран (задаёт порядок в выдаче)
+POPULAR_CITIES = {
+    "RU": ["MOW", "LED", "AER", "KZN", "SVX", "OVB", "UFA", "ROV", "MRV", "VVO"],
+    "KZ": ["ALA", "NQZ", "SCO", "GUW", "KGF"],
+    "BY": ["MSQ", "GME", "VTB"],
+    "AZ": ["GYD", "NAJ", "KVD"],
+    "AM": ["EVN", "LWN"],
+    "KG": ["FRU", "OSS"],
+    "MD": ["RMO"],
+    "TJ": ["DYU", "LBD"],
+    "TM": ["KRW", "MYP"],
+    "UZ": ["TAS", "SKD", "BHK"],
+    "UA": ["KBP", "HRK", "ODS"],
+    "US": ["JFK", "LAX", "SFO", "MIA", "ORD"],
+    "TR": ["IST", "SAW", "AYT", "ADB", "DLM"],
+    "BR": ["GRU", "GIG", "BSB", "REC", "FOR"],
+    "TH": ["BKK", "HKT", "CNX", "DMK", "KBV"]
+}
+
+def _build_city_indexes(cities: List[City]):
+    """Раскладывает города по словарям: страна -> города, код -> город,
+    (страна, имя/падеж в нижнем регистре) -> город. Порядок внутри страны
+    (популярные по рангу, остальные по алфавиту) вычисляется здесь один раз."""
+    for city in cities:
+        country_code = city.country_code.upper()
+        _cities_by_country.setdefault(country_code, []).append(city)
+        _cities_by_code[city.code] = city
+        _cities_by_name_lc[(country_code, city.name.lower())] = city
+        for case_value in city.cases.values():
+            _cities_by_name_lc[(country_code, case_value.lower())] = city
+
+    for country_code, country_cities in _cities_by_country.items():
+        ranks = {code: i for i, code in enumerate(POPULAR_CITIES.get(country_code, []))}
+        if ranks:
+            popular = sorted((c for c in country_cities if c.code in ranks), key=lambda c: ranks[c.code])
+            others = sorted((c for c in country_cities if c.code not in ranks), key=lambda c: c.name)
+            _cities_by_country[country_code] = popular + others
+        else:
+            country_cities.sort(key=lambda c: c.name)
+
 async def _load_countries() -> List[Country]:
     global _countries_cache
     if _countries_cache is not None:
         return _countries_cache
     url = "https://api.travelpayouts.com/data/ru/countries.json"
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        try:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    print(f"Ошибка API (страны): {resp.status} - {await resp.text()}")
-                    return []
-                data = await resp.json()
-                if not isinstance(data, list):
-                    print(f"Ошибка: countries.json не является списком, получен {type(data)}")
-                    return []
-                countries = [Country(code=c["code"], name=c["name"]) for c in data]
-                _countries_cache = countries
-                return countries
-        except aiohttp.ClientError as e:
-            print(f"Ошибка сети при получении стран: {e}")
+    try:
+        data = await _fetch_reference_json(url, _COUNTRIES_CACHE_FILE)
+        if data is None:
             return []
+        if not isinstance(data, list):
+            logger.error("Ошибка: countries.json не является списком, получен %s", type(data))
+            return []
+        countries = [Country(code=c["code"], name=c["name"]) for c in data]
+        _countries_cache = countries
+        return countries
+    except aiohttp.ClientError as e:
+        logger.error("Ошибка сети при получении стран: %s", e)
+        return []
 
 async def get_flightable_directions(origin: str) -> List[str]:
     global _directions_cache
@@ -130,84 +245,78 @@ async def get_flightable_directions(origin: str) -> List[str]:
         "currency": "rub",
         "token": TRAVELPAYOUTS_TOKEN
     }
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        try:
-            async with session.get(url, params=params) as resp:
-                if resp.status != 200:
-                    print(f"Ошибка API (городские направления): {resp.status} - {await resp.text()}")
-                    _directions_cache[origin] = []
-                    return []
-                data = await resp.json()
-                directions = [d["destination"] for d in data.get("data", {}).values() if is_valid_iata_code(d["destination"])]
-                _directions_cache[origin] = directions
-                return directions
-        except aiohttp.ClientError as e:
-            print(f"Ошибка сети при получении направлений: {e}")
-            _directions_cache[origin] = []
-            return []
+    session = get_http_session()
+    try:
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                logger.error("Ошибка API (городские направления): %s - %s", resp.status, await resp.text())
+                _directions_cache[origin] = []
+                return []
+            data = await resp.json()
+            directions = [d["destination"] for d in data.get("data", {}).values() if is_valid_iata_code(d["destination"])]
+            _directions_cache[origin] = directions
+            return directions
+    except aiohttp.ClientError as e:
+        logger.error("Ошибка сети при получении направлений: %s", e)
+        _directions_cache[origin] = []
+        return []
 
 async def get_countries() -> List[Country]:
     countries = await _load_countries()
     return countries if countries else []
 
 async def get_cities_by_country(country_code: str, is_origin: bool = False) -> List[City]:
-    cities = await _load_cities()
-    filtered = [city for city in cities if city.country_code.upper() == country_code.upper()]
-    
-    # Список популярных городов для разных стран
-    popular_cities = {
-        "RU": ["MOW", "LED", "AER", "KZN", "SVX", "OVB", "UFA", "ROV", "MRV", "VVO"],
-        "KZ": ["ALA", "NQZ", "SCO", "GUW", "KGF"],
-        "BY": ["MSQ", "GME", "VTB"],
-        "AZ": ["GYD", "NAJ", "KVD"],
-        "AM": ["EVN", "LWN"],
-        "KG": ["FRU", "OSS"],
-        "MD": ["RMO"],
-        "TJ": ["DYU", "LBD"],
-        "TM": ["KRW", "MYP"],
-        "UZ": ["TAS", "SKD", "BHK"],
-        "UA": ["KBP", "HRK", "ODS"],
-        "US": ["JFK", "LAX", "SFO", "MIA", "ORD"],
-        "TR": ["IST", "SAW", "AYT", "ADB", "DLM"],
-        "BR": ["GRU", "GIG", "BSB", "REC", "FOR"],
-        "TH": ["BKK", "HKT", "CNX", "DMK", "KBV"]
-    }
-    
-    # Приоритет для популярных городов
+    await _load_cities()
+    # Порядок (популярные, затем по алфавиту) уже вычислен при загрузке
+    return _cities_by_country.get(country_code.upper(), [])
+
+# Индексы код->город по странам, чтобы не сканировать список на каждый ввод
+_city_index_cache: Dict[str, Dict[str, City]] = {}
+
+async def get_city_index(country_code: str) -> Dict[str, City]:
+    """Возвращает словарь {код IATA: город} для страны (поиск за O(1))."""
     country_code = country_code.upper()
-    if country_code in popular_cities:
-        popular_codes = popular_cities[country_code]
-        popular = [city for city in filtered if city.code in popular_codes]
-        others = [city for city in filtered if city.code not in popular_codes]
-        popular.sort(key=lambda x: popular_codes.index(x.code))  # Сортировка по порядку в popular_cities
-        others.sort(key=lambda x: x.name)  # Остальные по алфавиту
-        return popular + others
-    else:
-        filtered.sort(key=lambda x: x.name)
-        return filtered
+    index = _city_index_cache.get(country_code)
+    if index is None:
+        cities = await get_cities_by_country(country_code)
+        index = {city.code: city for city in cities}
+        # Пустой индекс не кэшируем: если cities.json не загрузился,
+        # следующая попытка должна построить индекс заново
+        if index:
+            _city_index_cache[country_code] = index
+    return index
 
 async def find_city_by_name(city_name: str, country_code: str) -> Optional[City]:
-    cities = await _load_cities()
+    await _load_cities()
     city_name = city_name.strip()
     country_code = country_code.upper()
-    
+
     # Проверяем, является ли ввод кодом IATA
     if is_valid_iata_code(city_name.upper()):
-        for city in cities:
-            if city.country_code.upper() == country_code and city.code == city_name.upper():
-                return city
-    
-    # Проверяем совпадение по имени города и падежам
-    city_name_lower = city_name.lower()
-    for city in cities:
-        if city.country_code.upper() == country_code:
-            if city.name.lower() == city_name_lower:
-                return city
-            for case_value in city.cases.values():
-                if case_value.lower() == city_name_lower:
-                    return city
-    return None
+        city = _cities_by_code.get(city_name.upper())
+        if city and city.country_code.upper() == country_code:
+            return city
+
+    # Совпадение по имени города или падежу — один запрос к индексу
+    return _cities_by_name_lc.get((country_code, city_name.lower()))
+
+# Кэш результатов поиска цен: подписки и повторные запросы часто спрашивают
+# один и тот же маршрут. Кэшируем только непустые ответы, на короткое время.
+_flights_cache: Dict[tuple, tuple] = {}
+_flights_locks: Dict[tuple, "asyncio.Lock"] = {}
+_FLIGHTS_TTL = 600  # секунд
+
+def prune_flights_cache():
+    """Удаляет протухшие записи кэша цен вместе с их блокировками,
+    иначе словари растут по записи на каждую комбинацию параметров."""
+    cutoff = time.monotonic() - _FLIGHTS_TTL
+    for key in [k for k, (ts, _) in _flights_cache.items() if ts < cutoff]:
+        del _flights_cache[key]
+    # Блокировки чистим отдельно: пустые результаты не кэшируются,
+    # но setdefault в get_flights_for_date заводит замок и для них
+    for key in [k for k, lock in _flights_locks.items()
+                if not lock.locked() and k not in _flights_cache]:
+        del _flights_locks[key]
 
 async def get_flights_for_date(origin: str, destination: str, departure_date: str, passengers: int, max_transfers: Optional[int] = None) -> List[FlightPrice]:
     departure_date = normalize_date(departure_date)
@@ -216,6 +325,23 @@ async def get_flights_for_date(origin: str, destination: str, departure_date: st
     except ValueError:
         return []
 
+    key = (origin, destination, departure_date, passengers, max_transfers)
+    cached = _flights_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _FLIGHTS_TTL:
+        return list(cached[1])
+
+    # Блокировка на ключ: одновременные одинаковые запросы ждут один HTTP-вызов
+    lock = _flights_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        cached = _flights_cache.get(key)
+        if cached and time.monotonic() - cached[0] < _FLIGHTS_TTL:
+            return list(cached[1])
+        prices = await _fetch_flights_for_date(origin, destination, departure_date, passengers, max_transfers)
+        if prices:
+            _flights_cache[key] = (time.monotonic(), prices)
+        return list(prices)
+
+async def _fetch_flights_for_date(origin: str, destination: str, departure_date: str, passengers: int, max_transfers: Optional[int] = None) -> List[FlightPrice]:
     # Убираем фильтр на прямые рейсы, чтобы API мог искать с пересадками
     # directions = await get_flightable_directions(origin)
     # if destination not in directions:
@@ -230,44 +356,50 @@ async def get_flights_for_date(origin: str, destination: str, departure_date: st
         "one_way": "true",
         "token": TRAVELPAYOUTS_TOKEN
     }
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
     prices = []
 
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        try:
-            async with session.get(url, params=params) as resp:
-                if resp.status != 200:
-                    print(f"Ошибка API (цены): {resp.status} - {await resp.text()}")
-                    return []
-                data = await resp.json()
-                flights = data.get("data", [])
-                if not flights or not isinstance(flights, list):
-                    return []
-
-                for flight in flights:
-                    price_val = flight.get("price")
-                    transfers_count = flight.get("transfers", 0)
-                    if price_val:
-                        if max_transfers is not None and transfers_count > max_transfers:
-                            continue
-                        dep_time = normalize_datetime(flight.get("departure_at", departure_date))
-                        ticket_link = generate_aviasales_link(origin, destination, dep_time, passengers)
-                        prices.append(FlightPrice(
-                            origin=origin,
-                            destination=destination,
-                            price=price_val * passengers,
-                            departure_date=dep_time,
-                            origin_airport=flight.get("origin_airport", origin),
-                            destination_airport=flight.get("destination_airport", destination),
-                            ticket_link=ticket_link,
-                            passengers=passengers,
-                            transfers=transfers_count
-                        ))
-                prices.sort(key=lambda x: x.price)
-            return prices
-        except Exception as e:
-            print(f"Ошибка при получении цен: {e}")
-            return []
+    session = get_http_session()
+    try:
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                logger.error("Ошибка API (цены): %s - %s", resp.status, await resp.text())
+                return []
+            data = await resp.json()
+            flights = data.get("data", [])
+            if not flights or not isinstance(flights, list):
+                return []
+
+            for flight in flights:
+                price_val = flight.get("price")
+                transfers_count = flight.get("transfers", 0)
+                if price_val:
+                    if max_transfers is not None and transfers_count > max_transfers:
+                        continue
+                    # Парсим дату вылета один раз: и время для показа,
+                    # и ddmm для ссылки берём из одного datetime
+                    raw_dep = flight.get("departure_at", departure_date)
+                    try:
+                        dt = datetime.fromisoformat(raw_dep.replace("Z", "+00:00"))
+                    except ValueError:
+                        continue
+                    dep_time = dt.strftime("%Y-%m-%d %H:%M")
+                    ticket_link = generate_aviasales_link(origin, destination, dt, passengers)
+                    prices.append(FlightPrice(
+                        origin=origin,
+                        destination=destination,
+                        price=price_val * passengers,
+                        departure_date=dep_time,
+                        origin_airport=flight.get("origin_airport", origin),
+                        destination_airport=flight.get("destination_airport", destination),
+                        ticket_link=ticket_link,
+                        passengers=passengers,
+                        transfers=transfers_count
+                    ))
+            prices.sort(key=lambda x: x.price)
+        return prices
+    except Exception as e:
+        logger.error("Ошибка при получении цен: %s", e)
+        return []
 
 async def get_min_price(origin: str, destination: str, departure_date: str, passengers: int, max_transfers: Optional[int] = None) -> Optional[FlightPrice]:
     prices = await get_flights_for_date(origin, destination, departure_date, passengers, max_transfers)